@@ -1,6 +1,6 @@
 """Callbacks for mindspore.Model"""
 import os
-from time import time
+from time import perf_counter
 
 # import stat
 import numpy as np
@@ -8,7 +8,7 @@ import numpy as np
 import mindspore as ms
 from mindspore import ParameterTuple, SummaryRecord, Tensor, load_param_into_net
 from mindspore import log as logger
-from mindspore import ops, save_checkpoint
+from mindspore import ms_function, ops, save_checkpoint
 from mindspore.train.callback import Callback
 
 from .checkpoint_manager import CheckpointManager
@@ -19,6 +19,14 @@ __all__ = [
     "ValCallback",
 ]
 
+_hyper_map = ops.HyperMap()
+
+
+@ms_function
+def _assign_params(dst_params, src_params):
+    """Copy all parameters of `src_params` into `dst_params` within a single compiled graph."""
+    return _hyper_map(ops.assign, dst_params, src_params)
+
 
 class StateMonitor(Callback):
     """
@@ -53,12 +61,14 @@ class StateMonitor(Callback):
         self.dataset_val = dataset_val
         self.val_start_epoch = val_start_epoch
         self.save_best_ckpt = save_best_ckpt
-        self.metric_name = metric_name
+        self.metric_name = tuple(metric_name)
+        self._n_metrics = len(self.metric_name)
         self.best_res = 0
         self.val_interval = val_interval
         self.summary_dir = summary_dir
         self.rank_id = rank_id if rank_id is not None else 0
         self.device_num = device_num if rank_id is not None else 1
+        self._is_leader = self.rank_id == 0
         self.log_interval = log_interval
         self.model_name = model_name
         self.ckpt_dir = ckpt_dir
@@ -69,61 +79,70 @@ class StateMonitor(Callback):
         self.keep_checkpoint_max = keep_checkpoint_max
         self.ckpt_save_policy = ckpt_save_policy
         self._manager = CheckpointManager(ckpt_save_policy=self.ckpt_save_policy)
+        self._log_fh = None
         self._need_flush_from_cache = True
+        self._cache_params = None
         self.dataset_sink_mode = dataset_sink_mode
 
-        if self.rank_id in [0, None]:
+        if self._is_leader:
             if not os.path.isdir(ckpt_dir):
                 os.makedirs(ckpt_dir)
             self.log_txt_fp = os.path.join(ckpt_dir, "result.log")
-            result_log = "Epoch\tTrainLoss\t"
-            name_dict = {"Top_1_Accuracy": "ValAcc@1", "Top_5_Accuracy": "ValAcc@5"}
-            for i in range(len(self.metric_name)):
-                if self.metric_name[i] in name_dict.keys():
-                    result_log += name_dict[self.metric_name[i]] + "\t"
-                else:
-                    result_log += self.metric_name[i] + "\t"
-            result_log += "Time\n"
-            with open(self.log_txt_fp, "w", encoding="utf-8") as fp:
-                fp.write(result_log)
-
             self.best_ckpt_path = os.path.join(ckpt_dir, best_ckpt_name)
 
         if self.device_num > 1:
             self.all_reduce = AllReduceSum()
 
-        self.start = time()
-        self.epoch_start = time()
-        self.map = ops.HyperMap()
+        self.start = perf_counter()
+        self.epoch_start = perf_counter()
+        self._mean_op = ops.ReduceMean(keep_dims=False)
+        # fixed learning rate read from device, with the optimizer and epoch it was read in
+        self._static_lr_np = None
+        self._static_lr_key = None
+        self._res_buf = np.zeros(self._n_metrics, dtype=np.float32)
         self.ema = ema
         if self.ema:
             self.online_params = ParameterTuple(self.model.train_network.get_parameters())
             self.swap_params = self.online_params.clone("swap", "zeros")
+        self._ema_param_map = None
+        self._optimizer = None
 
     def __enter__(self):
         self.summary_record = SummaryRecord(self.summary_dir)
+        if self._is_leader:
+            name_dict = {"Top_1_Accuracy": "ValAcc@1", "Top_5_Accuracy": "ValAcc@5"}
+            result_log = "Epoch\tTrainLoss\t" + "".join(name_dict.get(m, m) + "\t" for m in self.metric_name) + "Time\n"
+            # keep the log file open during training instead of reopening it every epoch
+            self._log_fh = open(self.log_txt_fp, "w", buffering=1, encoding="utf-8")
+            self._log_fh.write(result_log)
         return self
 
     def __exit__(self, *exc_args):
         self.summary_record.close()
+        if self._log_fh is not None:
+            self._log_fh.close()
+            self._log_fh = None
 
     def apply_eval(self, run_context):
         """Model evaluation, return validation accuracy."""
         if self.ema:
             cb_params = run_context.original_args()
-            self.map(ops.assign, self.swap_params, self.online_params)
-            ema_dict = dict()
-            if self.dataset_sink_mode:
-                net = cb_params.train_network.network
-            else:
-                net = cb_params.train_network
-            for param in net.get_parameters():
-                if param.name.startswith("ema"):
-                    new_name = param.name.split("ema.")[1]
-                    ema_dict[new_name] = param.data
+            _assign_params(self.swap_params, self.online_params)
+            if self._ema_param_map is None:
+                if self.dataset_sink_mode:
+                    net = cb_params.train_network.network
+                else:
+                    net = cb_params.train_network
+                # the ema parameters never change, so map them to the online names only once
+                self._ema_param_map = [
+                    (param.name.split("ema.", 1)[1], param)
+                    for param in net.get_parameters()
+                    if param.name.startswith("ema")
+                ]
+            ema_dict = {name: param.data for name, param in self._ema_param_map}
             load_param_into_net(self.model.train_network.network, ema_dict)
             res = self.model.eval(self.dataset_val, dataset_sink_mode=False)
-            self.map(ops.assign, self.online_params, self.swap_params)
+            _assign_params(self.online_params, self.swap_params)
         else:
             res = self.model.eval(self.dataset_val, dataset_sink_mode=False)
 
@@ -132,34 +151,36 @@ class StateMonitor(Callback):
     def on_train_step_end(self, run_context):
         cb_params = run_context.original_args()
         num_batches = cb_params.batch_num
-        cur_epoch = cb_params.cur_epoch_num + self.last_epoch - 1  # (global_step-1) // num_batches
-        cur_step_in_epoch = int((cb_params.cur_step_num - 1) % cb_params.batch_num)
-
-        if cb_params.optimizer is not None:
-            optimizer = cb_params.optimizer
-        elif self.dataset_sink_mode:
-            optimizer = cb_params.train_network.network.optimizer
-        else:
-            optimizer = cb_params.train_network.optimizer
-
+        cur_step_in_epoch = int((cb_params.cur_step_num - 1) % num_batches)
+        # return as early as possible on the steps that are not logged
         if (
-            (cur_step_in_epoch + 1) % self.log_interval == 0
-            or (cur_step_in_epoch + 1) >= num_batches
-            or cur_step_in_epoch == 0
+            (cur_step_in_epoch + 1) % self.log_interval != 0
+            and (cur_step_in_epoch + 1) < num_batches
+            and cur_step_in_epoch != 0
         ):
-            step = optimizer.global_step
-            if optimizer.dynamic_lr:
-                cur_lr = optimizer.learning_rate(step - 1)[0].asnumpy()
-            else:
-                cur_lr = optimizer.learning_rate.asnumpy()
-            loss = self._get_loss(cb_params)
+            return
 
-            print(
-                f"Epoch: {cur_epoch+1}, "
-                f"batch:[{cur_step_in_epoch+1}/{num_batches}], "
-                f"loss:{loss.asnumpy():.6f}, lr: {cur_lr:.7f},  time:{time() - self.start:.6f}s"
-            )
-            self.start = time()
+        cur_epoch = cb_params.cur_epoch_num + self.last_epoch - 1  # (global_step-1) // num_batches
+        optimizer = self._get_optimizer(cb_params)
+        step = optimizer.global_step
+        if optimizer.dynamic_lr:
+            cur_lr = optimizer.learning_rate(step - 1)[0].asnumpy()
+        else:
+            # a fixed learning rate can only be changed in place (e.g. by a scheduler callback),
+            # so fetch it from device once per epoch for each optimizer
+            lr_key = self._static_lr_key
+            if lr_key is None or lr_key[0] is not optimizer or lr_key[1] != cur_epoch:
+                self._static_lr_np = optimizer.learning_rate.asnumpy()
+                self._static_lr_key = (optimizer, cur_epoch)
+            cur_lr = self._static_lr_np
+        loss = self._get_loss(cb_params)
+
+        print(
+            f"Epoch: {cur_epoch+1}, "
+            f"batch:[{cur_step_in_epoch+1}/{num_batches}], "
+            f"loss:{loss.asnumpy():.6f}, lr: {cur_lr:.7f},  time:{perf_counter() - self.start:.6f}s"
+        )
+        self.start = perf_counter()
 
     def on_train_epoch_end(self, run_context):
         """
@@ -167,55 +188,54 @@ class StateMonitor(Callback):
         save the best ckpt file with highest validation accuracy.
         """
         cb_params = run_context.original_args()
-        if cb_params.optimizer is not None:
-            optimizer = cb_params.optimizer
-        elif self.dataset_sink_mode:
-            optimizer = cb_params.train_network.network.optimizer
-        else:
-            optimizer = cb_params.train_network.optimizer
+        optimizer = self._get_optimizer(cb_params)
 
-        # the global step may larger than batch_size * epoch due to graph mode async
-        global_step = optimizer.global_step.asnumpy()[0]
         cur_epoch = cb_params.cur_epoch_num + self.last_epoch
         cur_step_in_epoch = cb_params.batch_num  # (global_step - 1) % cb_params.batch_num
 
         loss = self._get_loss(cb_params)
         self.summary_record.add_value("scalar", f"train_loss_{self.rank_id}", loss)
+        # fetch host copies once and reuse them for printing and logging
+        loss_np = float(loss.asnumpy().mean())
 
         # val while training if validation loader is not None
-        res = Tensor(np.zeros(len(self.metric_name)), ms.float32)
+        res_np = self._res_buf
+        res_np.fill(0.0)
         if self.dataset_val is not None:
             if cur_epoch >= self.val_start_epoch and (cur_epoch - self.val_start_epoch) % self.val_interval == 0:
-                val_time = time()
+                val_time = perf_counter()
                 mind_res = self.apply_eval(run_context)
-                for i in range(len(self.metric_name)):
-                    res[i] = mind_res[self.metric_name[i]] * 100
-
+                # gather all metrics into one tensor so that a single AllReduce is issued,
+                # the percentage scale and the device average are folded into one host-side factor
+                res_np[:] = [mind_res[m] for m in self.metric_name]
                 if self.device_num > 1:
-                    res = self.all_reduce(res)
-                    res /= self.device_num
+                    res = self.all_reduce(Tensor(res_np, ms.float32))
+                    res_np = res.asnumpy() * (100.0 / self.device_num)
+                else:
+                    res_np *= 100.0
                 # record val acc
-                if self.rank_id in [0, None]:
+                if self._is_leader:
                     metric_str = "Validation "
-                    for i in range(len(self.metric_name)):
-                        metric_str += self.metric_name[i] + ": " + str(res[i]) + ", "
-                    metric_str += f"time:{time() -val_time:.6f}s"
+                    for i, name in enumerate(self.metric_name):
+                        metric_str += name + ": " + str(res_np[i]) + ", "
+                    metric_str += f"time:{perf_counter() - val_time:.6f}s"
                     print(metric_str)
                     # Save the best ckpt file
-                    if res[0] > self.best_res:
-                        self.best_res = res[0]
+                    if res_np[0] > self.best_res:
+                        self.best_res = res_np[0]
                         self.best_epoch = cur_epoch
-                        if self.save_best_ckpt and (self.rank_id == 0):
+                        if self.save_best_ckpt:
                             save_checkpoint(cb_params.train_network, self.best_ckpt_path, async_save=True)
-                            print(f"=> New best val acc: {res[0].asnumpy():.3f}")
+                            print(f"=> New best val acc: {res_np[0]:.3f}")
 
-                    if not isinstance(res, Tensor):
-                        res = Tensor(res)
-                    for i in range(len(res)):
-                        self.summary_record.add_value("scalar", "val_" + self.metric_name[i], res[i])
+                    # scalar summaries only accept Tensor, build them from the host values already fetched
+                    for i, name in enumerate(self.metric_name):
+                        self.summary_record.add_value("scalar", "val_" + name, Tensor(float(res_np[i]), ms.float32))
 
         # log
-        if self.rank_id in [0, None]:
+        if self._is_leader:
+            # all checkpoints are saved with async_save=True, so the files are written by background
+            # threads and only the host copy of the parameters stays on the training critical path
             if (cur_epoch % self.ckpt_save_interval == 0) or (cur_epoch == cb_params.epoch_num):
                 if self._need_flush_from_cache:
                     self._flush_from_cache(cb_params)
@@ -231,7 +251,7 @@ class StateMonitor(Callback):
                 ckpoint_filelist = self._manager.save_ckpoint(
                     cb_params.train_network,
                     num_ckpt=self.keep_checkpoint_max,
-                    metric=res[0],
+                    metric=float(res_np[0]),
                     save_path=ckpt_save_path,
                 )
                 if self.ckpt_save_policy == "top_k":
@@ -240,25 +260,41 @@ class StateMonitor(Callback):
                 else:
                     print(f"Saving model to {ckpt_save_path}")
 
-            epoch_time = time() - self.epoch_start
+            epoch_time = perf_counter() - self.epoch_start
             print(f"Total time since last epoch: {epoch_time:.3f}")
             print("-" * 80)
-            self.epoch_start = time()
-            result_log = f"{cur_epoch}\t\t\t{loss.asnumpy():.7f}\t\t\t"
-            for i in range(len(res)):
-                result_log += f"{res[i].asnumpy():.3f}\t\t\t"
+            self.epoch_start = perf_counter()
+            result_log = f"{cur_epoch}\t\t\t{loss_np:.7f}\t\t\t"
+            for value in res_np:
+                result_log += f"{value:.3f}\t\t\t"
             result_log += f"{epoch_time:.2f}\n"
-            with open(self.log_txt_fp, "a", encoding="utf-8") as fp:
-                fp.write(result_log)
+            self._log_fh.write(result_log)
 
-        self.summary_record.record(int(global_step))
+        # the global step may larger than batch_size * epoch due to graph mode async,
+        # read it only here to avoid syncing with the device before the epoch-end work
+        global_step = int(optimizer.global_step.asnumpy()[0])
+        self.summary_record.record(global_step)
 
     # pylint: disable=unused-argument
     def on_train_end(self, run_context):
-        if self.dataset_val is not None and self.rank_id == 0:
+        if self.dataset_val is not None and self._is_leader:
             print("Finish training!")
             print(f"The best validation {self.metric_name[0]} is: {self.best_res} at epoch {self.best_epoch}.")
         print("=" * 80)
+        self._optimizer = None
+        self._static_lr_np = None
+        self._static_lr_key = None
+
+    def _get_optimizer(self, cb_params):
+        """Get the optimizer of the training network, it is resolved on first call and cached."""
+        if self._optimizer is None:
+            if cb_params.optimizer is not None:
+                self._optimizer = cb_params.optimizer
+            elif self.dataset_sink_mode:
+                self._optimizer = cb_params.train_network.network.optimizer
+            else:
+                self._optimizer = cb_params.train_network.optimizer
+        return self._optimizer
 
     def _get_loss(self, cb_params):
         """
@@ -266,7 +302,7 @@ class StateMonitor(Callback):
         Args:
             cb_params (_InternalCallbackParam): Callback parameters.
         Returns:
-            Union[Tensor, None], if parse loss success, will return a Tensor value(shape is [1]), else return None.
+            Union[Tensor, None], if parse loss success, will return a scalar Tensor, else return None.
         """
         output = cb_params.net_outputs
         if output is None:
@@ -289,19 +325,18 @@ class StateMonitor(Callback):
         if not isinstance(loss, Tensor):
             loss = Tensor(loss)
 
-        loss = Tensor(np.mean(loss.asnumpy()))
+        if loss.ndim > 0:
+            loss = self._mean_op(loss)
         return loss
 
     def _flush_from_cache(self, cb_params):
         """Flush cache data to host if tensor is cache enable."""
-        has_cache_params = False
-        params = cb_params.train_network.get_parameters()
-        for param in params:
-            if param.cache_enable:
-                has_cache_params = True
-                Tensor(param).flush_from_cache()
-        if not has_cache_params:
-            self._need_flush_from_cache = False
+        if self._cache_params is None:
+            self._cache_params = [param for param in cb_params.train_network.get_parameters() if param.cache_enable]
+            if not self._cache_params:
+                self._need_flush_from_cache = False
+        for param in self._cache_params:
+            Tensor(param).flush_from_cache()
 
     def remove_oldest_ckpoint_file(self):
         """Remove the oldest checkpoint file from this checkpoint manager and also from the directory."""
@@ -313,9 +348,19 @@ class ValCallback(Callback):
     def __init__(self, log_step_interval=100):
         super().__init__()
         self.log_step_interval = log_step_interval
+        # for power-of-two intervals the modulo check can be replaced by a bitwise and
+        if log_step_interval > 0 and (log_step_interval & (log_step_interval - 1)) == 0:
+            self._mask = log_step_interval - 1
+        else:
+            self._mask = None
 
     def on_eval_step_end(self, run_context):
         cb_params = run_context.original_args()
-        # cur_step_in_epoch = int((cb_params.cur_step_num - 1) % cb_params.batch_num)
-        if cb_params.cur_step_num % self.log_step_interval == 0:
-            print(f"{cb_params.cur_step_num }/{cb_params.batch_num}")
+        cur_step = cb_params.cur_step_num
+        if self._mask is not None:
+            skip = cur_step & self._mask
+        else:
+            skip = cur_step % self.log_step_interval
+        if skip:
+            return
+        print(f"{cur_step}/{cb_params.batch_num}")
@@ -5,6 +5,7 @@ import stat
 import numpy as np
 
 import mindspore as ms
+from mindspore import Tensor
 from mindspore import log as logger
 
 
@@ -80,7 +81,7 @@ class CheckpointManager:
     def top_K_checkpoint(self, network, K=10, metric=None, save_path=""):
         """Save and return Top K checkpoint address and accuracy."""
         last_file = self._ckpoint_filelist[-1] if self._ckpoint_filelist else None
-        if type(metric) is not np.ndarray:
+        if isinstance(metric, Tensor):
             metric = metric.asnumpy()
         if self.ckpoint_num < K or np.greater(metric, last_file[1]):
             if self.ckpoint_num >= K:
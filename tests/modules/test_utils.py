@@ -8,13 +8,14 @@ import numpy as np
 import pytest
 
 import mindspore as ms
-from mindspore import nn
+from mindspore import ParameterTuple, nn
 from mindspore.common.initializer import Normal
 from mindspore.nn import TrainOneStepCell, WithLossCell
 
 from mindcv.loss import create_loss
 from mindcv.optim import create_optimizer
 from mindcv.utils import CheckpointManager
+from mindcv.utils.callbacks import _assign_params
 
 ms.set_seed(1)
 np.random.seed(1)
@@ -59,7 +60,8 @@ def validate(model, data, label):
 
 @pytest.mark.parametrize("mode", [0, 1])
 @pytest.mark.parametrize("ckpt_save_policy", ["top_k", "latest_k"])
-def test_checkpoint_manager(mode, ckpt_save_policy):
+@pytest.mark.parametrize("metric_as_float", [False, True])
+def test_checkpoint_manager(mode, ckpt_save_policy, metric_as_float):
     ms.set_context(mode=mode)
 
     bs = 8
@@ -83,7 +85,32 @@ def test_checkpoint_manager(mode, ckpt_save_policy):
     for t in range(3):
         train_network(x, label)
         acc = validate(network, test_data, test_label)
+        if metric_as_float:
+            acc = float(acc.asnumpy())
         save_path = os.path.join("./" + f"network_{t + 1}.ckpt")
         ckpoint_filelist = manager.save_ckpoint(network, num_ckpt=2, metric=acc, save_path=save_path)
 
     assert len(ckpoint_filelist) == 2, "num of checkpoints is NOT correct"
+
+
+@pytest.mark.parametrize("mode", [0, 1])
+def test_ema_param_swap(mode):
+    ms.set_context(mode=mode)
+
+    network = SimpleCNN(in_channels=1, num_classes=10)
+    online_params = ParameterTuple(network.get_parameters())
+    swap_params = online_params.clone("swap", "zeros")
+    online_values = [param.asnumpy().copy() for param in online_params]
+
+    # backup online parameters, as StateMonitor.apply_eval does before loading the ema ones
+    _assign_params(swap_params, online_params)
+    for param, value in zip(swap_params, online_values):
+        np.testing.assert_allclose(param.asnumpy(), value)
+
+    for param in online_params:
+        param.set_data(ms.Tensor(np.ones(param.shape), param.dtype))
+
+    # restore the online parameters after evaluation
+    _assign_params(online_params, swap_params)
+    for param, value in zip(online_params, online_values):
+        np.testing.assert_allclose(param.asnumpy(), value)